@@ -8,49 +8,234 @@
 import collections
 from datetime import datetime, timedelta
 import logging
+import os
+import sqlite3
 import time
 import json
 import traceback
 # 3rd Party Imports
+import gevent
 import requests
 from requests.packages.urllib3.util.retry import Retry
+from gevent.event import AsyncResult
 from gevent.lock import Semaphore
+from gevent.pool import Pool
+try:
+    # Optional, noticeably faster for (de)serializing JSON
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
 # Local Imports
 from PokeAlarm import Unknown
 from PokeAlarm.Utilities.GenUtils import synchronize_with
 
 log = logging.getLogger('Gmaps')
 
+# Parameters sent with every Nominatim request
+_BASE_PARAMS = {'format': 'json'}
+
+# Reverse geocode DTS fields, the Nominatim address keys they are taken from
+# (in order of preference) and the default if none of the keys are present.
+# Note: for addresses on unnamed roads, EMPTY is preferred for 'street_num'
+# and 'street' to avoid DTS looking weird
+_REV_MAP = (
+    ('street_num', ('house_number', 'house_name'), Unknown.EMPTY),
+    ('street', ('road', 'street', 'city_block', 'retail'), Unknown.EMPTY),
+    ('postal', ('postcode',), Unknown.REGULAR),
+    ('country', ('country', 'country_code'), Unknown.REGULAR),
+    ('state', ('region', 'state'), Unknown.REGULAR),
+    ('city', ('village', 'town', 'city', 'municipality'), Unknown.REGULAR),
+    ('county', ('county', 'state_district'), Unknown.REGULAR),
+    ('neighborhood', ('neighbourhood', 'allotments', 'quarter'),
+     Unknown.REGULAR),
+    ('sublocality', ('city_district', 'district', 'borough', 'suburb',
+                     'subdivision'), Unknown.REGULAR),
+)
+
+
+def _build_rev_extractor(fields):
+    """ Compiles a function returning the fields of a Nominatim address.
+
+    The table is fixed, so it is unrolled into a single dict display of
+    conditional expressions instead of being walked on every lookup. """
+    namespace = {}
+    entries = []
+    for i, (field, keys, default) in enumerate(fields):
+        namespace['default_{}'.format(i)] = default
+        expr = ''.join("d[{0!r}] if {0!r} in d else ".format(k) for k in keys)
+        entries.append("        {!r}: {}default_{},".format(field, expr, i))
+    src = "def _extract(d):\n    return {{\n{}\n    }}\n".format(
+        "\n".join(entries))
+    exec(compile(src, '<_REV_MAP>', 'exec'), namespace)
+    return namespace['_extract']
+
+
+_rev_extract = _build_rev_extractor(_REV_MAP)
+
 
 class GMaps(object):
 
     # Maximum number of requests per second
     _queries_per_second = 50
+    # Connect and read timeouts for requests (seconds)
+    _timeout = (1.0, 2.0)
     # How often to warn about going over query limit
     _warning_window = timedelta(minutes=1)
+    # Maximum number of memoized results per cache
+    _cache_max = 4096
+    # How long failed lookups are memoized before being retried (seconds)
+    _negative_ttl = 300
+    # Memoization caches (LRU), shared by all instances
+    _geocode_hist = collections.OrderedDict()
+    _reverse_geocode_hist = collections.OrderedDict()
+    _cache_lock = Semaphore()
+    # Reverse geocode lookups in progress, shared by all instances
+    _reverse_geocode_pending = {}
+    # Optional SQLite database persisting results across restarts
+    _db = None
+    _db_lock = Semaphore()
+    # How long persisted results are used before being looked up again
+    _db_max_age = 30 * 24 * 60 * 60  # seconds
+    # How often expired results are deleted from the database (seconds)
+    _db_prune_interval = 60 * 60
+    _db_pruned = 0
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, pool_size=None):
         self._key = api_key
-        self._lock = Semaphore
+        # Split the key into the server url and optional credentials
+        creds, sep, server = api_key.partition('@')
+        if sep:
+            user, _, password = creds.partition(':')
+            self._auth = (user, password)
+            self._base_url = server
+        else:
+            self._auth = None
+            self._base_url = api_key
+        # Guards the rate limiting window shared by all requests
+        self._lock = Semaphore()
 
         # Create a session to handle connections
-        self._session = self._create_session()
+        if pool_size is None:
+            pool_size = self._queries_per_second
+        self._session = self._create_session(pool_size=pool_size)
 
-        # Sliding window for rate limiting
-        self._window = collections.deque(maxlen=self._queries_per_second)
+        # Sliding window counter for rate limiting
+        self._cur_sec = 0
+        self._cur_count = 0
+        self._prev_count = 0
         self._time_limit = datetime.utcnow()
 
-        # Memoization dicts
-        self._geocode_hist = {}
-        self._reverse_geocode_hist = {}
+    def _cache_get(self, cache, key):
+        """ Returns a memoized result and marks it as recently used.
+        Raises KeyError if the result is missing or has expired. """
+        with self._cache_lock:
+            value, expires = cache[key]
+            if expires is not None and expires < time.time():
+                del cache[key]
+                raise KeyError(key)
+            cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, cache, key, value, negative=False):
+        """ Memoizes a result, evicting the least recently used one.
+        Negative (failed) results expire after _negative_ttl seconds. """
+        expires = time.time() + self._negative_ttl if negative else None
+        with self._cache_lock:
+            cache[key] = (value, expires)
+            cache.move_to_end(key)
+            if len(cache) > self._cache_max:
+                cache.popitem(last=False)
+
+    @classmethod
+    def enable_cache_db(cls, path):
+        """ Persist successful lookups to the SQLite database at path. """
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                   'key TEXT PRIMARY KEY, lat REAL, lng REAL, ts INTEGER)')
+        db.execute('CREATE TABLE IF NOT EXISTS rev ('
+                   'key TEXT PRIMARY KEY, payload BLOB, ts INTEGER)')
+        cls._db = db
+        with cls._db_lock:
+            cls._db_prune(int(time.time()))
+        log.info("Persisting GMaps results to {}".format(path))
+
+    @classmethod
+    def _db_prune(cls, now):
+        """ Deletes persisted results older than _db_max_age.
+        Must be called while holding _db_lock. """
+        cutoff = now - cls._db_max_age
+        cls._db.execute('DELETE FROM geocode WHERE ts <= ?', (cutoff,))
+        cls._db.execute('DELETE FROM rev WHERE ts <= ?', (cutoff,))
+        cls._db_pruned = now
+
+    def _db_fetch(self, query, key):
+        """ Returns the persisted row for key, or None if there is none.
+        The query must also select on 'ts > ?' to skip expired results. """
+        if self._db is None:
+            return None
+        cutoff = int(time.time()) - self._db_max_age
+        try:
+            with self._db_lock:
+                return self._db.execute(
+                    query, (repr(key), cutoff)).fetchone()
+        except sqlite3.Error as e:
+            log.error("Unable to read from GMaps cache db: {}".format(e))
+            return None
+
+    def _db_store(self, query, key, *values):
+        """ Persists values (and the current time) for key. """
+        if self._db is None:
+            return
+        now = int(time.time())
+        try:
+            with self._db_lock:
+                self._db.execute(query, (repr(key),) + values + (now,))
+                if now - self._db_pruned > self._db_prune_interval:
+                    self._db_prune(now)
+        except sqlite3.Error as e:
+            log.error("Unable to write to GMaps cache db: {}".format(e))
+
+    @staticmethod
+    def _single_flight(pending, key, lookup):
+        """ Returns lookup(), running it only once per key at a time.
+        Concurrent callers for the same key wait for the first caller's
+        result instead of repeating the lookup. """
+        result = pending.get(key)
+        if result is not None:
+            return result.get()
+        result = pending[key] = AsyncResult()
+        try:
+            value = lookup()
+        except BaseException as e:
+            result.set_exception(e)
+            raise
+        else:
+            result.set(value)
+            return value
+        finally:
+            del pending[key]
 
     # TODO: Move into utilities
     @staticmethod
-    def _create_session(retry_count=3, pool_size=3, backoff=.25):
+    def _create_session(retry_count=1, pool_size=50, backoff=.1):
         """ Create a session to use connection pooling. """
 
         # Create a session for connection pooling and
         session = requests.Session()
+        # Nominatim's usage policy requires an identifying User-Agent
+        session.headers.update({
+            'Connection': 'keep-alive',
+            'User-Agent':
+                'PokeAlarm/GMaps (+https://github.com/PokeAlarm/PokeAlarm)',
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate'
+        })
 
         # Reattempt connection on these statuses
         status_forcelist = [500, 502, 503, 504]
@@ -59,61 +244,84 @@ class GMaps(object):
         retry_policy = Retry(
             total=retry_count,
             backoff_factor=backoff,
-            status_forcelist=status_forcelist
+            status_forcelist=status_forcelist,
+            respect_retry_after_header=True
         )
 
         # Define an Adapter, to limit pool and implement retry policy
         adapter = requests.adapters.HTTPAdapter(
             max_retries=retry_policy,
             pool_connections=pool_size,
-            pool_maxsize=pool_size
+            pool_maxsize=pool_size,
+            pool_block=False
         )
 
-        # Apply Adapter for all HTTPS (no HTTP for you!)
+        # Apply Adapter for HTTPS and HTTP (private servers may use either)
         session.mount('https://', adapter)
+        session.mount('http://', adapter)
 
         return session
 
+    def _wait_for_quota(self):
+        """ Blocks until a request fits in the sliding window counter. """
+        while True:
+            now = time.time()
+            sec = int(now)
+            if sec != self._cur_sec:
+                # Roll the window over to the new second
+                if sec == self._cur_sec + 1:
+                    self._prev_count = self._cur_count
+                else:
+                    self._prev_count = 0
+                self._cur_count = 0
+                self._cur_sec = sec
+            elapsed_time = now - sec
+            # Weight the previous second by how much of it is still in window
+            rate = self._prev_count * (1 - elapsed_time) + self._cur_count
+            if rate < self._queries_per_second:
+                self._cur_count += 1
+                return
+            if self._cur_count >= self._queries_per_second:
+                # Sleep off the rest of the current second
+                delay = 1 - elapsed_time
+            else:
+                # Sleep until enough of the previous second has slid out
+                free = self._queries_per_second - self._cur_count
+                delay = 1 - free / self._prev_count - elapsed_time
+            gevent.sleep(max(delay, 0.001))
+
     def _make_request(self, service, params=None):
         """ Make a request to the GMAPs API. """
         # Rate Limit - All APIs use the same quota
-        if len(self._window) == self._queries_per_second:
-            # Calculate elapsed time since start of window
-            elapsed_time = time.time() - self._window[0]
-            if elapsed_time < 1:
-                # Sleep off the difference
-                time.sleep(1 - elapsed_time)
+        with self._lock:
+            self._wait_for_quota()
 
         # Create the correct url
-        if '@' in self._key:
-            userpassword = self._key.split("@")[0]
-            url = self._key.split("@")[1] + "/" + service
-        else:
-            userpassword = False
-            url = self._key.split("@")[0] + "/" + service
-        
+        url = self._base_url + "/" + service
+
         # Use the session to send the request
-        log.debug('{} request sending.'.format(service))
-        self._window.append(time.time())
-        if userpassword:
-#            request = self._session.get(url, params=params, auth=(userpassword.split(":")[0], userpassword.split(":")[1]), timeout=3, verify=False)
-            request = self._session.get(url, params=params, auth=(userpassword.split(":")[0], userpassword.split(":")[1]), timeout=3)
-        else:
-#            request = self._session.get(url, params=params, timeout=3, verify=False)
-            request = self._session.get(url, params=params, timeout=3)
+        log.debug('%s request sending.', service)
+        request = self._session.get(
+            url, params=params, auth=self._auth, timeout=self._timeout)
         if not request.ok:
-            log.debug('Response body: {}'.format(
-                json.dumps(request.json(), indent=4, sort_keys=True)))
+            # Only pretty print the body when it will actually be logged
+            if log.isEnabledFor(logging.DEBUG):
+                try:
+                    log.debug('Response body: %s', json.dumps(
+                        request.json(), indent=4, sort_keys=True))
+                except ValueError:
+                    log.debug('Response body: %s', request.text)
             # Raise HTTPError
             request.raise_for_status()
 
-        log.debug('{} request completed successfully with response {}.'
-                  ''.format(service, request.status_code))
-        body = request.json()
+        log.debug('%s request completed successfully with response %s.',
+                  service, request.status_code)
+        body = json_loads(request.content)
+
+        # Search returns a list of matches, only the best one is used
+        if service == 'search' and isinstance(body, list):
+            body = body[0] if body else {}
 
-        if type(body) is list:
-            body = body[0]
-            
         if 'error' not in body:
             return body
         else:
@@ -128,33 +336,48 @@ class GMaps(object):
         """ Returns 'lat,lng' associated with the name of the place. """
         # Check for memoized results
         address = address.lower()
-        if address in self._geocode_hist:
-            return self._geocode_hist[address]
+        key = (self._base_url, address, language)
+        try:
+            return self._cache_get(self._geocode_hist, key)
+        except KeyError:
+            pass
+        # Check for persisted results
+        row = self._db_fetch(
+            'SELECT lat, lng FROM geocode WHERE key = ? AND ts > ?', key)
+        if row is not None:
+            latlng = tuple(row)
+            self._cache_put(self._geocode_hist, key, latlng)
+            return latlng
         # Set default in case something happens
         latlng = None
         try:
             # Set parameters and make the request
-            params = {'q': address, 'accept-language': language, format: 'json'}
+            params = {**_BASE_PARAMS, 'q': address,
+                      'accept-language': language}
             response = self._make_request('search', params)
             # Extract the results and format into a dict
-            if 'lat' in response and 'lng' in response:
-                latlng = float(response['lat']), float(response['lng'])
-
-            # Memoize the results
-            self._geocode_hist[address] = latlng
+            if 'lat' in response and 'lon' in response:
+                latlng = float(response['lat']), float(response['lon'])
         except requests.exceptions.HTTPError as e:
             log.error("Geocode failed with "
-                      "HTTPError: {}".format(e.message))
+                      "HTTPError: {}".format(e))
         except requests.exceptions.Timeout as e:
             log.error("Geocode failed with "
-                      "connection issues: {}".format(e.message))
+                      "connection issues: {}".format(e))
         except UserWarning:
             log.error("Geocode failed because of exceeded quota.")
         except Exception as e:
             log.error("Geocode failed because "
                       "unexpected error has occurred: "
-                      "{} - {}".format(type(e).__name__, e.message))
+                      "{} - {}".format(type(e).__name__, e))
             log.error("Stack trace: \n {}".format(traceback.format_exc()))
+        # Memoize the results, retrying failed lookups after a while
+        self._cache_put(self._geocode_hist, key, latlng,
+                        negative=latlng is None)
+        if latlng is not None:
+            self._db_store(
+                'INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)',
+                key, latlng[0], latlng[1])
         # Send back tuple
         return latlng
 
@@ -172,54 +395,87 @@ class GMaps(object):
         'country': Unknown.REGULAR
     }
 
-    @synchronize_with()
+    # Not synchronized with a method-wide lock, so different locations can be
+    # looked up concurrently (see reverse_geocode_many). Concurrent lookups of
+    # the same location share a single request instead.
     def reverse_geocode(self, latlng, language='en'):
         # type: (tuple) -> dict
         """ Returns the reverse geocode DTS associated with 'lat,lng'. """
-        latlng_hist = '{:.5f},{:.5f}'.format(latlng[0], latlng[1])
+        key = (self._base_url, round(latlng[0], 5), round(latlng[1], 5),
+               language)
         # Check for memoized results
-        if latlng_hist in self._reverse_geocode_hist:
-            return self._reverse_geocode_hist[latlng_hist]
-        # Get defaults in case something happens
-        dts = self._reverse_geocode_defaults.copy()
+        try:
+            return self._cache_get(self._reverse_geocode_hist, key)
+        except KeyError:
+            pass
+        return self._single_flight(
+            self._reverse_geocode_pending, key,
+            lambda: self._lookup_reverse_geocode(key, latlng, language))
+
+    def _lookup_reverse_geocode(self, key, latlng, language):
+        """ Looks up and memoizes the reverse geocode DTS for key. """
+        # Check for persisted results
+        row = self._db_fetch(
+            'SELECT payload FROM rev WHERE key = ? AND ts > ?', key)
+        if row is not None:
+            try:
+                dts = json_loads(row[0])
+            except ValueError as e:
+                # Treat it as a miss, it is replaced by the new lookup
+                log.error(
+                    "Unable to decode GMaps cache db entry: {}".format(e))
+            else:
+                self._cache_put(self._reverse_geocode_hist, key, dts)
+                return dts
+        found = False
         try:
             # Set parameters and make the request
-            params = {'lat': latlng[0], 'lon': latlng[1], 'accept-language': language, 'format': 'json'}
+            params = {**_BASE_PARAMS, 'lat': latlng[0], 'lon': latlng[1],
+                      'accept-language': language}
             response = self._make_request('reverse', params)
             # Extract the results and format into a dict
             if 'address' in response:
-                details = response.get('address', [])
-                # Note: for addresses on unnamed roads, EMPTY is preferred for
-                # 'street_num' and 'street' to avoid DTS looking weird
-                dts['street_num'] = details.get('house_number', details.get('house_name', Unknown.EMPTY))
-                dts['street'] = details.get('road', details.get('street', details.get('city_block', details.get('retail', Unknown.EMPTY))))
-                dts['address'] = u"{} {}".format(dts['street_num'], dts['street'])
-                dts['address_eu'] = u"{} {}".format(dts['street'], dts['street_num'])  # Europeans are backwards
-                dts['postal'] = details.get('postcode', Unknown.REGULAR)
-                dts['country'] = details.get('country', details.get('country_code', Unknown.REGULAR))
-                dts['state'] = details.get('region', details.get('state', Unknown.REGULAR))
-                dts['city'] = details.get('village', details.get('town', details.get('city', details.get('municipality', Unknown.REGULAR))))
-                dts['county'] = details.get('county', details.get('state_district', Unknown.REGULAR))
-                dts['neighborhood'] = details.get('neighbourhood', details.get('allotments', details.get('quarter', Unknown.REGULAR)))
-                dts['sublocality'] = details.get('city_district', details.get('district', details.get('borough', details.get('suburb', details.get('subdivision', Unknown.REGULAR)))))
-            # Memoize the results
-            self._reverse_geocode_hist[latlng] = dts
+                found = True
+                # Every field is set from the table, so no defaults copy needed
+                dts = _rev_extract(response['address'])
+                dts['address'] = u"{} {}".format(
+                    dts['street_num'], dts['street'])
+                # Europeans are backwards
+                dts['address_eu'] = u"{} {}".format(
+                    dts['street'], dts['street_num'])
         except requests.exceptions.HTTPError as e:
             log.error("Reverse Geocode failed with "
-                      "HTTPError: {}".format(e.message))
+                      "HTTPError: {}".format(e))
         except requests.exceptions.Timeout as e:
             log.error("Reverse Geocode failed with "
-                      "connection issues: {}".format(e.message))
+                      "connection issues: {}".format(e))
         except UserWarning:
             log.error("Reverse Geocode failed because of exceeded quota.")
         except Exception as e:
             log.error("Reverse Geocode failed because "
                       "unexpected error has occurred: "
-                      "{} - {}".format(type(e).__name__, e.message))
+                      "{} - {}".format(type(e).__name__, e))
             log.error("Stack trace: \n {}".format(traceback.format_exc()))
+        if not found:
+            # Fall back to the defaults
+            dts = dict(self._reverse_geocode_defaults)
+        # Memoize the results, retrying failed lookups after a while
+        self._cache_put(self._reverse_geocode_hist, key, dts,
+                        negative=not found)
+        if found:
+            self._db_store('INSERT OR REPLACE INTO rev VALUES (?, ?, ?)',
+                           key, json_dumps(dts))
         # Send back dts
         return dts
 
+    def reverse_geocode_many(self, latlngs, language='en'):
+        # type: (list, str) -> list
+        """ Returns the reverse geocode DTS for each 'lat,lng' in order,
+        making the requests concurrently within the rate limit. """
+        pool = Pool(self._queries_per_second)
+        return pool.map(
+            lambda latlng: self.reverse_geocode(latlng, language), latlngs)
+
     @synchronize_with()
     def distance_matrix(self, mode, origin, dest, lang, units):
 
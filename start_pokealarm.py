@@ -21,6 +21,7 @@ import PokeAlarm.Events as Events
 from PokeAlarm import config
 from PokeAlarm.Utilities.Logging import setup_std_handler, setup_file_handler
 from PokeAlarm.Cache import cache_options
+from PokeAlarm.LocationServices import GMaps
 from PokeAlarm.Manager import Manager
 from PokeAlarm.Utils import get_path, parse_boolean
 from PokeAlarm.Load import parse_rules_file, parse_filters_file, \
@@ -230,6 +231,10 @@ def parse_settings(root_path):
     parser.add_argument(
         '--gmaps-dm-transit', type=parse_boolean, action='append',
         default=[None], help='Enable Transit Distance Matrix DTS.')
+    parser.add_argument(
+        '--gmaps-cache-db', default=None,
+        help='SQLite file to persist GMaps results across restarts. '
+             'default: None')
 
     # Misc
     parser.add_argument(
@@ -286,6 +291,9 @@ def parse_settings(root_path):
     config['CONCURRENCY'] = args.concurrency
     config['DEBUG'] = args.debug
 
+    if args.gmaps_cache_db is not None:
+        GMaps.enable_cache_db(get_path(args.gmaps_cache_db))
+
     # Check to make sure that the same number of arguments are included
     for arg in [args.gmaps_key, args.filters, args.alarms, args.rules,
                 args.geofences, args.location, args.locale, args.units,
@@ -0,0 +1,340 @@
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import gevent
+
+from PokeAlarm.LocationServices import GMaps
+
+# The package re-exports the class under the module's name
+gmaps_module = importlib.import_module('PokeAlarm.LocationServices.GMaps')
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class MockResponse(object):
+    """ Stands in for a requests.Response with a JSON body. """
+
+    def __init__(self, body, status_code=200):
+        self.content = json.dumps(body).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class MockSession(object):
+    """ Stands in for a requests.Session, replying based on the service. """
+
+    def __init__(self, search=None, reverse=None, delay=0):
+        self.responses = {'search': search, 'reverse': reverse}
+        self.delay = delay
+        self.calls = []
+
+    def get(self, url, params=None, auth=None, timeout=None):
+        service = url.rsplit('/', 1)[1]
+        self.calls.append((service, params))
+        if self.delay:
+            gevent.sleep(self.delay)  # Let other greenlets run
+        body = self.responses[service]
+        if isinstance(body, Exception):
+            raise body
+        return MockResponse(body)
+
+
+def reverse_body(road):
+    """ Generate a reverse geocode response for an address on road. """
+    return {'address': {'house_number': '1', 'road': road, 'city': 'Town'}}
+
+
+class TestGMaps(unittest.TestCase):
+
+    def setUp(self):
+        # Memoization is shared by all instances, so start each test clean
+        GMaps._geocode_hist.clear()
+        GMaps._reverse_geocode_hist.clear()
+        self.session = MockSession(
+            search=[{'lat': '1.5', 'lon': '2.5'}],
+            reverse=reverse_body('Main St'))
+        self.gmaps = self.gen_gmaps(self.session)
+
+    def tearDown(self):
+        if GMaps._db is not None:
+            GMaps._db.close()
+            GMaps._db = None
+
+    @staticmethod
+    def gen_gmaps(session, api_key='https://nominatim.test'):
+        """ Generate a GMaps instance using the given mock session. """
+        gmaps = GMaps(api_key)
+        gmaps._session = session
+        return gmaps
+
+    def run_quota(self, now, count):
+        """ Wait for quota count times at a mocked time, returning sleeps. """
+        clock = [now]
+
+        def sleep(seconds):
+            clock[0] += seconds
+        with mock.patch.object(gmaps_module.time, 'time',
+                               side_effect=lambda: clock[0]), \
+                mock.patch.object(gmaps_module.gevent, 'sleep',
+                                  side_effect=sleep) as mock_sleep:
+            for _ in range(count):
+                self.gmaps._wait_for_quota()
+        return [c[0][0] for c in mock_sleep.call_args_list]
+
+    def test_quota_allows_full_second(self):
+        sleeps = self.run_quota(1000.25, GMaps._queries_per_second)
+        self.assertEqual(sleeps, [])
+        self.assertEqual(self.gmaps._cur_sec, 1000)
+        self.assertEqual(self.gmaps._cur_count, GMaps._queries_per_second)
+        self.assertEqual(self.gmaps._prev_count, 0)
+
+    def test_quota_sleeps_off_full_second(self):
+        self.run_quota(1000.25, GMaps._queries_per_second)
+        sleeps = self.run_quota(1000.25, 1)
+        # Waits out the rest of the second, then for the window to slide
+        self.assertAlmostEqual(sleeps[0], 0.75)
+        self.assertEqual(self.gmaps._cur_sec, 1001)
+        self.assertEqual(self.gmaps._prev_count, GMaps._queries_per_second)
+        self.assertEqual(self.gmaps._cur_count, 1)
+
+    def test_quota_rollover(self):
+        self.run_quota(1000.5, 10)
+        # The next second keeps the previous count
+        self.assertEqual(self.run_quota(1001.5, 1), [])
+        self.assertEqual(self.gmaps._cur_sec, 1001)
+        self.assertEqual(self.gmaps._prev_count, 10)
+        self.assertEqual(self.gmaps._cur_count, 1)
+        # Skipping a second forgets it
+        self.assertEqual(self.run_quota(1003.5, 1), [])
+        self.assertEqual(self.gmaps._cur_sec, 1003)
+        self.assertEqual(self.gmaps._prev_count, 0)
+        self.assertEqual(self.gmaps._cur_count, 1)
+
+    def test_quota_sleeps_until_window_slides(self):
+        self.gmaps._cur_sec = 1001
+        self.gmaps._prev_count = 50
+        self.gmaps._cur_count = 20
+        # 50 * 0.8 + 20 = 60 requests in window, 10 of the previous
+        # second's (a fifth of a second) need to slide out first
+        sleeps = self.run_quota(1001.2, 1)
+        self.assertAlmostEqual(sleeps[0], 0.2)
+        self.assertEqual(self.gmaps._cur_count, 21)
+
+    def test_quota_limits_rate(self):
+        clock = [1000.0]
+        times = []
+
+        def sleep(seconds):
+            clock[0] += seconds
+        with mock.patch.object(gmaps_module.time, 'time',
+                               side_effect=lambda: clock[0]), \
+                mock.patch.object(gmaps_module.gevent, 'sleep',
+                                  side_effect=sleep):
+            for _ in range(500):
+                self.gmaps._wait_for_quota()
+                times.append(clock[0])
+                clock[0] += 0.001
+        for start in times:
+            in_window = [t for t in times if start <= t < start + 1]
+            self.assertLessEqual(len(in_window), GMaps._queries_per_second)
+
+    def test_cache_negative_results_expire(self):
+        cache = GMaps._geocode_hist
+        with mock.patch.object(gmaps_module.time, 'time') as mock_time:
+            mock_time.return_value = 1000
+            self.gmaps._cache_put(cache, 'bad', None, negative=True)
+            self.gmaps._cache_put(cache, 'good', (1.0, 2.0))
+            mock_time.return_value = 1000 + GMaps._negative_ttl
+            self.assertIsNone(self.gmaps._cache_get(cache, 'bad'))
+            mock_time.return_value = 1001 + GMaps._negative_ttl
+            self.assertRaises(KeyError, self.gmaps._cache_get, cache, 'bad')
+            self.assertNotIn('bad', cache)
+            # Positive results never expire
+            mock_time.return_value = 1000000
+            self.assertEqual(self.gmaps._cache_get(cache, 'good'), (1.0, 2.0))
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = GMaps._geocode_hist
+        with mock.patch.object(GMaps, '_cache_max', 3):
+            for key in ['a', 'b', 'c']:
+                self.gmaps._cache_put(cache, key, key)
+            self.gmaps._cache_get(cache, 'a')  # 'b' is now the oldest
+            self.gmaps._cache_put(cache, 'd', 'd')
+        self.assertEqual(list(cache), ['c', 'a', 'd'])
+        self.assertRaises(KeyError, self.gmaps._cache_get, cache, 'b')
+
+    def test_geocode_failure_retried_after_ttl(self):
+        self.session.responses['search'] = ValueError('boom')
+        with mock.patch.object(gmaps_module.time, 'time') as mock_time:
+            mock_time.return_value = 1000
+            with self.assertLogs('Gmaps', level='ERROR'):
+                self.assertIsNone(self.gmaps.geocode('Nowhere'))
+            self.assertIsNone(self.gmaps.geocode('nowhere'))
+            self.assertEqual(len(self.session.calls), 1)
+
+            mock_time.return_value = 1001 + GMaps._negative_ttl
+            self.session.responses['search'] = [{'lat': '1.5', 'lon': '2.5'}]
+            self.assertEqual(self.gmaps.geocode('nowhere'), (1.5, 2.5))
+            self.assertEqual(len(self.session.calls), 2)
+
+    def enable_cache_db(self):
+        """ Persist results to a new database, returning its path. """
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'cache', 'gmaps.sqlite')
+        GMaps.enable_cache_db(path)
+        return path
+
+    def clear_memory(self):
+        """ Forget memoized results, as if PokeAlarm was restarted. """
+        GMaps._geocode_hist.clear()
+        GMaps._reverse_geocode_hist.clear()
+
+    def test_cache_db_round_trip(self):
+        path = self.enable_cache_db()
+        self.assertTrue(os.path.isfile(path))
+        latlng = self.gmaps.geocode('Somewhere')
+        dts = self.gmaps.reverse_geocode((1.0, 2.0))
+        self.assertEqual(len(self.session.calls), 2)
+
+        self.clear_memory()
+        self.session.responses['search'] = ValueError('offline')
+        self.session.responses['reverse'] = ValueError('offline')
+        self.assertEqual(self.gmaps.geocode('somewhere'), latlng)
+        self.assertEqual(self.gmaps.reverse_geocode((1.0, 2.0)), dts)
+        self.assertEqual(len(self.session.calls), 2)
+        # Loaded back into memory
+        self.assertIn((self.gmaps._base_url, 1.0, 2.0, 'en'),
+                      GMaps._reverse_geocode_hist)
+
+    def test_cache_db_bad_payload_is_a_miss(self):
+        self.enable_cache_db()
+        dts = self.gmaps.reverse_geocode((1.0, 2.0))
+        GMaps._db.execute("UPDATE rev SET payload = 'not json'")
+        self.clear_memory()
+        with self.assertLogs('Gmaps', level='ERROR'):
+            self.assertEqual(self.gmaps.reverse_geocode((1.0, 2.0)), dts)
+        self.assertEqual(len(self.session.calls), 2)
+        # The bad entry was replaced
+        self.clear_memory()
+        self.assertEqual(self.gmaps.reverse_geocode((1.0, 2.0)), dts)
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_cache_db_skips_failures(self):
+        self.enable_cache_db()
+        self.session.responses['reverse'] = ValueError('offline')
+        with self.assertLogs('Gmaps', level='ERROR'):
+            self.gmaps.reverse_geocode((1.0, 2.0))
+        count = GMaps._db.execute('SELECT COUNT(*) FROM rev').fetchone()[0]
+        self.assertEqual(count, 0)
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_cache_db_bytes_payload(self):
+        self.enable_cache_db()
+        dts = self.gmaps.reverse_geocode((1.0, 2.0))
+        payload = GMaps._db.execute('SELECT payload FROM rev').fetchone()[0]
+        self.assertIsInstance(payload, bytes)
+        self.clear_memory()
+        self.assertEqual(self.gmaps.reverse_geocode((1.0, 2.0)), dts)
+        self.assertEqual(len(self.session.calls), 1)
+
+    def test_cache_db_expires_and_prunes(self):
+        path = self.enable_cache_db()
+        with mock.patch.object(gmaps_module.time, 'time') as mock_time:
+            mock_time.return_value = 1000
+            self.gmaps.reverse_geocode((1.0, 2.0))
+            self.clear_memory()
+            # Too old to be used, so it's looked up again
+            mock_time.return_value = 1000 + GMaps._db_max_age
+            self.gmaps.reverse_geocode((1.0, 2.0))
+            self.assertEqual(len(self.session.calls), 2)
+            # Deleted when the database is opened
+            GMaps._db.execute("UPDATE rev SET ts = 0")
+            GMaps._db.close()
+            GMaps.enable_cache_db(path)
+        count = GMaps._db.execute('SELECT COUNT(*) FROM rev').fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_geocode_request(self):
+        self.assertEqual(self.gmaps.geocode('Some Place', 'de'), (1.5, 2.5))
+        self.assertEqual(self.session.calls, [('search', {
+            'format': 'json', 'q': 'some place', 'accept-language': 'de'})])
+
+    def test_geocode_no_match(self):
+        self.session.responses['search'] = []
+        self.assertIsNone(self.gmaps.geocode('Nowhere'))
+
+    def test_reverse_geocode_memoized_by_rounded_key(self):
+        dts = self.gmaps.reverse_geocode((1.0000001, 2.0000001))
+        self.assertEqual(dts['address'], '1 Main St')
+        self.assertEqual(dts['address_eu'], 'Main St 1')
+        self.assertEqual(dts['city'], 'Town')
+        # Within rounding of the first lookup, so no new request
+        self.assertIs(self.gmaps.reverse_geocode((1.0, 2.0)), dts)
+        self.assertEqual(len(self.session.calls), 1)
+        self.assertEqual(list(GMaps._reverse_geocode_hist),
+                         [(self.gmaps._base_url, 1.0, 2.0, 'en')])
+
+    def test_reverse_geocode_failure_copies_defaults(self):
+        self.session.responses['reverse'] = ValueError('boom')
+        with self.assertLogs('Gmaps', level='ERROR'):
+            dts = self.gmaps.reverse_geocode((1.0, 2.0))
+        self.assertEqual(dts, GMaps._reverse_geocode_defaults)
+        self.assertIsNot(dts, GMaps._reverse_geocode_defaults)
+
+    def test_reverse_geocode_many_keeps_order(self):
+        streets = {(1.0, 1.0): 'First St', (2.0, 2.0): 'Second St',
+                   (3.0, 3.0): 'Third St'}
+
+        def get(url, params=None, **kwargs):
+            self.session.calls.append(('reverse', params))
+            # Answer the first location last
+            gevent.sleep(0.01 * (4 - params['lat']))
+            return MockResponse(
+                reverse_body(streets[(params['lat'], params['lon'])]))
+        self.session.get = get
+
+        latlngs = [(3.0, 3.0), (1.0, 1.0), (2.0, 2.0)]
+        results = self.gmaps.reverse_geocode_many(latlngs)
+        self.assertEqual([r['street'] for r in results],
+                         ['Third St', 'First St', 'Second St'])
+
+    def test_reverse_geocode_many_dedupes_requests(self):
+        self.session.delay = 0.01
+        self.gmaps.reverse_geocode((1.0, 1.0))
+        self.assertEqual(len(self.session.calls), 1)
+
+        latlngs = [(1.0, 1.0), (2.0, 2.0), (2.0, 2.0), (1.0, 1.0), (2.0, 2.0)]
+        results = self.gmaps.reverse_geocode_many(latlngs)
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assertEqual(result['address'], '1 Main St')
+        # Only (2.0, 2.0) needed a new request
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_reverse_geocode_shared_between_instances(self):
+        self.session.delay = 0.01
+        others = [self.gen_gmaps(self.session) for _ in range(2)]
+        greenlets = [gevent.spawn(g.reverse_geocode, (1.0, 2.0))
+                     for g in [self.gmaps] + others]
+        gevent.joinall(greenlets)
+        self.assertEqual(len(self.session.calls), 1)
+        for greenlet in greenlets:
+            self.assertEqual(greenlet.value['address'], '1 Main St')
+        self.assertEqual(GMaps._reverse_geocode_pending, {})
+
+
+if __name__ == '__main__':
+    unittest.main()